@@ -52,9 +52,15 @@ async def process_file(file_path: str, use_aws: bool, status_label, results_cont
         df_clean = limpiar_datos(df_raw)
         df_final = validar_y_multiplicar(df_clean, 'config.json')
 
-        # Exportar
+        # Exportar. xlsxwriter escribe valores puros bastante más rápido que
+        # openpyxl; si no está instalado se usa openpyxl como antes. No usar
+        # constant_memory: to_excel escribe columna por columna y ese modo
+        # descarta en silencio las filas ya cerradas
         output_file = 'productos_final.xlsx'
-        df_final.to_excel(output_file, index=False, engine='openpyxl')
+        try:
+            df_final.to_excel(output_file, index=False, engine='xlsxwriter')
+        except ModuleNotFoundError:
+            df_final.to_excel(output_file, index=False, engine='openpyxl')
 
         # Actualizar inventario
         if not df_final.empty:
@@ -1,23 +1,42 @@
+import concurrent.futures
+import functools
+import io
 import json
+import os
+import threading
 from pathlib import Path
 import gradio as gr
 import pandas as pd
 from datetime import datetime
 from textract import (
     extract_tables_from_image,
+    leer_csv_raw,
     limpiar_datos,
     validar_y_multiplicar,
     actualizar_inventario_layout
 )
 
 
-def load_config():
-    """Carga la configuración desde config.json"""
+@functools.lru_cache(maxsize=1)
+def _load_config_cached(mtime_ns):
+    """Parsea config.json; el argumento mtime_ns invalida el caché al editarlo"""
     config_path = Path(__file__).parent / 'config.json'
     with open(config_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
 
+def load_config():
+    """Carga la configuración desde config.json (cacheada mientras no cambie)"""
+    config_path = Path(__file__).parent / 'config.json'
+    return _load_config_cached(os.stat(config_path).st_mtime_ns)
+
+
+# Caché del pipeline sin AWS: si datos_raw.csv no cambió (mtime + tamaño) y
+# el tipo de operación es el mismo, clicks repetidos de PROCESAR reutilizan
+# el resultado ya validado en vez de releer y relimpiar el CSV
+_csv_pipeline_cache = {'key': None, 'df_final': None}
+
+
 def limpiar_archivos_temporales():
     """
     Elimina archivos temporales antes de iniciar un nuevo procesamiento.
@@ -103,34 +122,55 @@ def process_file(files, tipo_operacion, inventario_inicial, fecha_inventario):
         # Crear carpeta de uploads
         (base_path / 'uploads').mkdir(exist_ok=True)
 
-        status_msg = "⏳ Iniciando procesamiento...\n\n"
+        # Acumular el status en una lista y unirla al final: evita la
+        # concatenación cuadrática de strings cuando el log crece con muchos
+        # archivos
+        status_parts = ["⏳ Iniciando procesamiento...\n\n"]
 
         # Limpiar archivos temporales de procesamiento anterior
-        status_msg += "🧹 Limpiando archivos temporales...\n"
+        status_parts.append("🧹 Limpiando archivos temporales...\n")
         archivos_limpiados = limpiar_archivos_temporales()
         if archivos_limpiados > 0:
-            status_msg += f"  ✓ {archivos_limpiados} archivo(s) temporal(es) eliminado(s)\n"
-        status_msg += "\n"
+            status_parts.append(f"  ✓ {archivos_limpiados} archivo(s) temporal(es) eliminado(s)\n")
+        status_parts.append("\n")
 
-        all_results = []
+        # Lock para la escritura de datos_raw.csv: con varios archivos en
+        # paralelo todos escriben el mismo CSV de respaldo
+        lock_csv = threading.Lock()
+
+        def procesar_archivo(file_path):
+            """
+            Procesa UN archivo (extracción + limpieza + validación).
 
-        for file_path in files:
+            Devuelve (mensajes, df_final o None); los mensajes se concatenan
+            en orden al final para que el status no se mezcle entre hilos.
+            """
+            status_parts = []  # lista local: cada hilo acumula sus mensajes
             file_name = Path(file_path).name
-            status_msg += f"📄 Procesando: {file_name}\n"
+            status_parts.append(f"📄 Procesando: {file_name}\n")
 
-            # Copiar archivo a uploads
+            # Llevar el archivo a uploads con un hard link (instantáneo, no
+            # relee el archivo); si el temporal de Gradio está en otro
+            # filesystem (EXDEV), caer a la copia normal
             upload_path = base_path / 'uploads' / file_name
             if str(file_path) != str(upload_path):
-                import shutil
-                shutil.copy2(file_path, upload_path)
+                if upload_path.exists():
+                    upload_path.unlink()
+                try:
+                    os.link(file_path, upload_path)
+                except OSError:
+                    import shutil
+                    shutil.copy2(file_path, upload_path)
+
+            clave_csv = None  # clave de caché solo para el camino sin AWS
 
             if use_aws:
-                status_msg += "  → Extrayendo con AWS Textract...\n"
+                status_parts.append("  → Extrayendo con AWS Textract...\n")
                 dataframes = extract_tables_from_image(str(upload_path))
 
                 if not dataframes:
-                    status_msg += "  ⚠️ No se encontraron tablas\n\n"
-                    continue
+                    status_parts.append("  ⚠️ No se encontraron tablas\n\n")
+                    return ''.join(status_parts), None
 
                 # Filtrar y seleccionar la tabla correcta
                 if len(dataframes) > 1:
@@ -175,57 +215,87 @@ def process_file(files, tipo_operacion, inventario_inicial, fecha_inventario):
                     palabras_resumen = ['sub total', 'subtotal', 'descuento', 'iva', 'ibua', 'vr. total', 'total factura']
                     es_resumen = any(palabra in todas_columnas_str or palabra in todas_filas_str for palabra in palabras_resumen)
                     if es_resumen:
-                        status_msg += "  ⚠️ Solo se detectó tabla de resumen financiero, no productos\n\n"
-                        continue
+                        status_parts.append("  ⚠️ Solo se detectó tabla de resumen financiero, no productos\n\n")
+                        return ''.join(status_parts), None
 
                 csv_path = Path(__file__).parent / 'datos_raw.csv'
-                df_raw.to_csv(csv_path, index=False, encoding='utf-8-sig')
-                status_msg += f"  ✓ Extraídas {len(dataframes)} tabla(s)\n"
+                with lock_csv:
+                    df_raw.to_csv(csv_path, index=False, encoding='utf-8-sig')
+                status_parts.append(f"  ✓ Extraídas {len(dataframes)} tabla(s)\n")
             else:
-                status_msg += "  → Cargando desde CSV...\n"
+                status_parts.append("  → Cargando desde CSV...\n")
                 csv_path = Path(__file__).parent / 'datos_raw.csv'
-                df_raw = pd.read_csv(csv_path, encoding='utf-8-sig')
-                status_msg += "  ✓ Datos cargados\n"
+                stat_csv = os.stat(csv_path)
+                clave_csv = (stat_csv.st_mtime_ns, stat_csv.st_size, tipo_operacion.lower())
+                if _csv_pipeline_cache['key'] == clave_csv:
+                    status_parts.append("  ✓ CSV sin cambios, reutilizando resultado anterior\n\n")
+                    return ''.join(status_parts), _csv_pipeline_cache['df_final']
+                df_raw = leer_csv_raw(csv_path)
+                status_parts.append("  ✓ Datos cargados\n")
 
             # Limpiar datos (diferente según tipo de operación)
-            status_msg += "  → Limpiando datos...\n"
+            status_parts.append("  → Limpiando datos...\n")
             df_clean = limpiar_datos(df_raw, tipo_operacion=tipo_operacion.lower())
-            status_msg += f"  ✓ {len(df_clean)} productos encontrados\n"
+            status_parts.append(f"  ✓ {len(df_clean)} productos encontrados\n")
 
             if len(df_clean) == 0:
-                status_msg += "  ⚠️ No se encontraron productos en este archivo\n\n"
-                continue
+                status_parts.append("  ⚠️ No se encontraron productos en este archivo\n\n")
+                return ''.join(status_parts), None
 
-            # Validar y multiplicar
-            status_msg += "  → Validando productos...\n"
-            config_path = Path(__file__).parent / 'config.json'
-            df_final = validar_y_multiplicar(df_clean, str(config_path), tipo_operacion=tipo_operacion.lower())
-            status_msg += f"  ✓ {len(df_final)} productos validados\n"
+            # Validar y multiplicar (reutilizando el config ya parseado)
+            status_parts.append("  → Validando productos...\n")
+            df_final = validar_y_multiplicar(df_clean, config, tipo_operacion=tipo_operacion.lower())
+            status_parts.append(f"  ✓ {len(df_final)} productos validados\n")
 
             if len(df_final) == 0:
-                status_msg += "  ⚠️ Ningún producto validado (no coinciden con config.json)\n\n"
-                continue
+                status_parts.append("  ⚠️ Ningún producto validado (no coinciden con config.json)\n\n")
+                return ''.join(status_parts), None
+
+            status_parts.append("\n")
+
+            if clave_csv is not None:
+                _csv_pipeline_cache['key'] = clave_csv
+                _csv_pipeline_cache['df_final'] = df_final
+
+            return ''.join(status_parts), df_final
 
-            status_msg += "\n"
+        # Procesar los archivos en paralelo: las llamadas a Textract y las
+        # lecturas de CSV son independientes y dominadas por I/O, así que un
+        # pool de hilos las solapa. executor.map preserva el orden de envío.
+        # actualizar_inventario_layout (más abajo) sigue siendo secuencial:
+        # openpyxl no es thread-safe sobre el mismo workbook
+        all_results = []
+        if len(files) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+                resultados = list(executor.map(procesar_archivo, files))
+        else:
+            resultados = [procesar_archivo(files[0])]
 
-            all_results.append(df_final)
+        for msg_archivo, df_final in resultados:
+            status_parts.append(msg_archivo)
+            if df_final is not None:
+                all_results.append(df_final)
 
         # Combinar todos los resultados
         if not all_results:
             return (
-                status_msg + "\n❌ No se procesaron archivos exitosamente",
+                ''.join(status_parts) + "\n❌ No se procesaron archivos exitosamente",
                 None,
                 "0",
                 "0",
                 "0"
             )
 
-        df_combined = pd.concat(all_results, ignore_index=True)
+        # Con un solo archivo no hace falta concatenar (ni copiar) nada
+        if len(all_results) == 1:
+            df_combined = all_results[0]
+        else:
+            df_combined = pd.concat(all_results, ignore_index=True)
 
         # Verificar que el DataFrame tenga datos y la columna Categoria
         if df_combined.empty or 'Categoria' not in df_combined.columns:
             return (
-                status_msg + "\n❌ No se encontraron productos válidos en los archivos procesados",
+                ''.join(status_parts) + "\n❌ No se encontraron productos válidos en los archivos procesados",
                 None,
                 "0",
                 "0",
@@ -237,7 +307,7 @@ def process_file(files, tipo_operacion, inventario_inicial, fecha_inventario):
 
         if tipo_operacion.lower() == 'entrada':
             # ENTRADA: Agrupar por categoría y SUMAR todas las cantidades
-            status_msg += "  → Agrupando y sumando cantidades por categoría...\n"
+            status_parts.append("  → Agrupando y sumando cantidades por categoría...\n")
 
             # Agrupar por categoría y sumar cantidades
             df_agrupado = df_combined.groupby('Categoria', as_index=False).agg({
@@ -250,22 +320,39 @@ def process_file(files, tipo_operacion, inventario_inicial, fecha_inventario):
             df_combined = df_agrupado
             productos_agrupados = productos_antes - len(df_combined)
             if productos_agrupados > 0:
-                status_msg += f"  ✓ {productos_agrupados} productos agrupados (sumando cantidades)\n"
-            status_msg += f"  ✓ {len(df_combined)} categorías únicas con cantidades totales\n"
+                status_parts.append(f"  ✓ {productos_agrupados} productos agrupados (sumando cantidades)\n")
+            status_parts.append(f"  ✓ {len(df_combined)} categorías únicas con cantidades totales\n")
         else:
             # SALIDA: Eliminar duplicados manteniendo solo el primero
-            status_msg += "  → Eliminando productos duplicados...\n"
+            status_parts.append("  → Eliminando productos duplicados...\n")
             df_combined = df_combined.drop_duplicates(subset=['Categoria'], keep='first')
 
             productos_eliminados = productos_antes - len(df_combined)
             if productos_eliminados > 0:
-                status_msg += f"  ✓ {productos_eliminados} productos duplicados eliminados\n"
-            status_msg += f"  ✓ {len(df_combined)} productos únicos\n"
+                status_parts.append(f"  ✓ {productos_eliminados} productos duplicados eliminados\n")
+            status_parts.append(f"  ✓ {len(df_combined)} productos únicos\n")
 
         # Exportar a Excel temporal
         output_file = Path(__file__).parent / 'productos_final.xlsx'
-        df_combined.to_excel(output_file, index=False, engine='openpyxl')
-        status_msg += f"💾 Productos procesados temporalmente\n"
+        # Escribir primero a un buffer en RAM y volcarlo a disco en un hilo
+        # aparte: el click interactivo no espera la escritura (la tabla se
+        # muestra desde df_combined, el archivo es solo un respaldo temporal).
+        # xlsxwriter escribe valores puros bastante más rápido que openpyxl;
+        # si no está instalado se usa openpyxl como antes.
+        # OJO: no usar constant_memory aquí — to_excel escribe las celdas
+        # columna por columna y ese modo descarta filas ya "cerradas",
+        # produciendo celdas vacías en silencio
+        buffer_excel = io.BytesIO()
+        try:
+            df_combined.to_excel(buffer_excel, index=False, engine='xlsxwriter')
+        except ModuleNotFoundError:
+            df_combined.to_excel(buffer_excel, index=False, engine='openpyxl')
+        threading.Thread(
+            target=output_file.write_bytes,
+            args=(buffer_excel.getvalue(),),
+            daemon=True
+        ).start()
+        status_parts.append(f"💾 Productos procesados temporalmente\n")
 
         # Generar nombre de archivo de inventario con fecha en formato DD_MM_YYYY
         # Parsear la fecha del calendario (viene en formato ISO: YYYY-MM-DD o YYYY-MM-DD HH:MM:SS)
@@ -294,26 +381,26 @@ def process_file(files, tipo_operacion, inventario_inicial, fecha_inventario):
             )
             if result_path:
                 # Mostrar ruta de Descargas
-                status_msg += f"💾 Inventario guardado en Descargas: inventario_{fecha_formateada}.xlsx\n"
+                status_parts.append(f"💾 Inventario guardado en Descargas: inventario_{fecha_formateada}.xlsx\n")
             else:
-                status_msg += f"⚠️ Error al guardar inventario\n"
+                status_parts.append(f"⚠️ Error al guardar inventario\n")
 
-        status_msg += "\n✅ PROCESAMIENTO COMPLETADO"
+        status_parts.append("\n✅ PROCESAMIENTO COMPLETADO")
 
         # Preparar resultados
         num_productos = str(len(df_combined))
         cantidad_original = f"{df_combined['Cantidad_Original'].sum():.0f}"
         cantidad_final = f"{df_combined['Cantidad_Final'].sum():.0f}"
 
-        # Formatear tabla para visualización
-        df_display = df_combined[['Producto', 'Cantidad_Original', 'Multiplicador', 'Cantidad_Final', 'Categoria']].copy()
-        df_display.columns = ['Producto', 'Cantidad', 'Multiplicador', 'Total', 'Categoría']
+        # Formatear tabla para visualización (solo lectura, sin copiar datos)
+        df_display = df_combined[['Producto', 'Cantidad_Original', 'Multiplicador', 'Cantidad_Final', 'Categoria']] \
+            .set_axis(['Producto', 'Cantidad', 'Multiplicador', 'Total', 'Categoría'], axis=1)
 
         # Retornar ruta de Descargas
         ruta_amigable = f"Descargas/inventario_{fecha_formateada}.xlsx"
 
         return (
-            status_msg,
+            ''.join(status_parts),
             df_display,
             num_productos,
             cantidad_original,
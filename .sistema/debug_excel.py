@@ -0,0 +1,25 @@
+import sys
+import io
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+
+from openpyxl import load_workbook
+
+# Inspeccionar las categorías del layout de inventario.
+# read_only + data_only: solo se parsean los valores en streaming, sin cargar
+# estilos ni fórmulas (el load completo es lo que hace lento abrir el layout)
+archivo = sys.argv[1] if len(sys.argv) > 1 else 'Inventario_layout.xlsx'
+
+wb = load_workbook(archivo, read_only=True, data_only=True)
+ws = wb.active
+
+print(f'=== CATEGORIAS EN {archivo} ===')
+print(f'Dimensiones: {ws.max_row} filas x {ws.max_column} columnas\n')
+
+categorias = 0
+for fila_idx, (valor,) in enumerate(ws.iter_rows(min_col=1, max_col=1, values_only=True), start=1):
+    if valor is not None and str(valor).strip():
+        print(f'  Fila {fila_idx}: {valor}')
+        categorias += 1
+
+print(f'\nTotal filas con datos en columna A: {categorias}')
+wb.close()
@@ -1,11 +1,339 @@
 import boto3
+import numpy as np
 import pandas as pd
 import json
 import re
+import functools
+import itertools
+import concurrent.futures
+from botocore.config import Config
 from typing import List, Dict
 from pathlib import Path
 import sys
 
+# pyarrow es opcional: su parser de CSV en C++ multihilo es varias veces más
+# rápido que pandas.read_csv; si no está instalado se usa pandas como siempre
+try:
+    import pyarrow.csv as _pacsv
+except ImportError:
+    _pacsv = None
+
+# orjson es opcional: parsea JSON 2-5x más rápido que el json estándar
+# (implementación en C); sin él se usa json.load como siempre
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+# pyahocorasick es opcional: con él el fallback por substring de la
+# validación busca TODAS las entradas del config dentro del producto en una
+# sola pasada del autómata, en vez de probar entrada por entrada
+try:
+    import ahocorasick as _ahocorasick
+except ImportError:
+    _ahocorasick = None
+
+# lxml acelera ~2x el parseo XML de openpyxl (lo usa solo con tenerlo
+# instalado, sin cambios de API). Avisar si falta para que la instalación
+# incompleta sea visible sin romper el procesamiento
+try:
+    from lxml import etree as _lxml_etree  # noqa: F401
+except ImportError:
+    print("[ADVERTENCIA] lxml no esta instalado: openpyxl usara el parser "
+          "XML estandar (mas lento). Instalar con: pip install lxml")
+
+# Configuración del cliente de Textract: pool de conexiones amplio para las
+# llamadas en paralelo y reintentos adaptativos ante throttling de AWS
+_TEXTRACT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    read_timeout=60
+)
+_textract_client = None
+
+
+def _cargar_config(config_path) -> Dict:
+    """
+    Devuelve la configuración como diccionario.
+
+    Acepta un dict ya parseado (por ejemplo, el cacheado por la interfaz
+    Gradio) o una ruta a config.json, evitando re-parsear el JSON en cada
+    llamada cuando el caller ya lo tiene cargado.
+    """
+    if isinstance(config_path, dict):
+        return config_path
+    if _orjson is not None:
+        return _orjson.loads(Path(config_path).read_bytes())
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _aplanar_config(config: Dict, campo: str) -> List:
+    """
+    Aplana config.json a una lista de tuplas (texto_norm, categoria, multiplicador).
+
+    Normaliza cada texto del campo ('entrada' o 'salida') UNA sola vez aquí,
+    de modo que los loops por fila comparen contra claves ya normalizadas en
+    vez de re-normalizar el mismo config en cada iteración.
+    """
+    planas = []
+    for categoria, info in config.items():
+        if not isinstance(info, dict) or 'variantes' not in info:
+            continue
+        for variante in info['variantes']:
+            multiplicador = variante.get('multiplicador', 1)
+            for texto in variante.get(campo, []):
+                planas.append((normalizar_texto(texto), categoria, multiplicador))
+    return planas
+
+
+def leer_csv_raw(csv_path) -> pd.DataFrame:
+    """
+    Lee el CSV de datos crudos (datos_raw.csv) a un DataFrame.
+
+    Con pyarrow instalado la lectura se hace con su parser multihilo y el
+    resultado se convierte a pandas; sin pyarrow se mantiene pandas.read_csv
+    con la misma codificación utf-8-sig de siempre.
+    """
+    if _pacsv is not None:
+        tabla = _pacsv.read_csv(
+            str(csv_path),
+            read_options=_pacsv.ReadOptions(encoding='utf-8-sig')
+        )
+        return tabla.to_pandas()
+    return pd.read_csv(csv_path, encoding='utf-8-sig', thousands=None, decimal='.')
+
+
+# Prefijos basura al inicio del nombre de producto: numeración ("1.", "14.-")
+# y errores de OCR ("I ", "| "). Una sola alternación compilada cubre también
+# combinaciones como "1. I PRODUCTO"
+_PREFIJOS_PRODUCTO = re.compile(r'^(?:\d+[\.\-\s]+[\|\s]*|[I\|i]\s*)+')
+
+# Todo lo que NO es letra (incluyendo acentos y ñ) ni dígito: se elimina al
+# normalizar texto. Compilado una vez a nivel de módulo
+_NORM_RE = re.compile(r'[^a-záéíóúñ0-9]')
+
+
+def _get_textract():
+    """
+    Devuelve el cliente de Textract cacheado a nivel de módulo.
+
+    Crear el cliente es costoso (resolución de credenciales, descubrimiento de
+    endpoint, pool HTTPS nuevo); reutilizarlo mantiene las conexiones calientes.
+    """
+    global _textract_client
+    if _textract_client is None:
+        _textract_client = boto3.client('textract', config=_TEXTRACT_CONFIG)
+    return _textract_client
+
+
+# Sobre este tamaño conviene subir la imagen a S3 en vez de mandarla inline
+# (el payload inline se infla ~33% por el base64)
+_UMBRAL_S3_BYTES = 1_000_000
+
+_s3_client = None
+
+
+def _get_s3():
+    """Cliente de S3 cacheado a nivel de módulo, igual que el de Textract"""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+_CACHE_TEXTRACT_DIR = Path(__file__).parent / '.textract_cache'
+
+
+def _bucket_configurado() -> str:
+    """Bucket de S3 opcional definido en config.json (clave "S3_BUCKET")"""
+    try:
+        config = _cargar_config(Path(__file__).parent / 'config.json')
+        return config.get('S3_BUCKET', '')
+    except (OSError, json.JSONDecodeError):
+        return ''
+
+
+def _analizar_documento(textract, image_bytes: bytes) -> Dict:
+    """
+    Llama analyze_document con los bytes inline o vía S3 según el tamaño.
+
+    La respuesta se cachea en disco en .textract_cache/<sha256>.json:
+    reprocesar el mismo documento (mismo contenido, no mismo nombre) lee el
+    JSON local en vez de volver a llamar — y facturar — a Textract.
+
+    Si config.json define un bucket en "S3_BUCKET" y la imagen supera
+    _UMBRAL_S3_BYTES, se sube una vez al bucket y Textract la lee directo de
+    S3 (evita la inflación base64 y la copia extra del payload). Sin bucket
+    configurado, o para imágenes chicas, se usa el camino inline de siempre.
+    Solo feature TABLES para minimizar costos.
+    """
+    import hashlib
+
+    hash_imagen = hashlib.sha256(image_bytes).hexdigest()
+    ruta_cache = _CACHE_TEXTRACT_DIR / f'{hash_imagen}.json'
+    try:
+        datos = ruta_cache.read_bytes()
+        return _orjson.loads(datos) if _orjson is not None else json.loads(datos)
+    except (OSError, ValueError):
+        pass  # sin cache (o corrupto): se llama a Textract normalmente
+
+    bucket = _bucket_configurado()
+    if bucket and len(image_bytes) > _UMBRAL_S3_BYTES:
+        key = f"textract-tmp/{hash_imagen}.png"
+        _get_s3().put_object(Bucket=bucket, Key=key, Body=image_bytes)
+        response = textract.analyze_document(
+            Document={'S3Object': {'Bucket': bucket, 'Name': key}},
+            FeatureTypes=['TABLES']
+        )
+    else:
+        response = textract.analyze_document(
+            Document={'Bytes': image_bytes},
+            FeatureTypes=['TABLES']
+        )
+
+    # Guardar en cache con mejor esfuerzo: si el disco falla, la respuesta
+    # igual se devuelve y solo se pierde el ahorro de la próxima corrida
+    try:
+        _CACHE_TEXTRACT_DIR.mkdir(exist_ok=True)
+        if _orjson is not None:
+            ruta_cache.write_bytes(_orjson.dumps(response))
+        else:
+            ruta_cache.write_text(json.dumps(response), encoding='utf-8')
+    except (OSError, TypeError):
+        pass
+
+    return response
+
+
+def _renderizar_pagina(pdf_path: str, page_num: int, dpi: int = 300) -> bytes:
+    """
+    Rasteriza una página de un PDF a bytes PNG.
+
+    El documento se reabre dentro de la función porque fitz.Document no es
+    picklable: así puede ejecutarse como worker de un ProcessPoolExecutor
+    y aprovechar varios núcleos para el render (que es CPU-bound).
+
+    Args:
+        pdf_path: Ruta al PDF local
+        page_num: Número de página (base 0)
+        dpi: Resolución del render
+
+    Returns:
+        Bytes de la imagen de la página
+    """
+    import fitz  # PyMuPDF
+
+    pdf_document = fitz.open(pdf_path)
+    try:
+        pix = pdf_document[page_num].get_pixmap(dpi=dpi)
+        # A 300 dpi el Deflate de PNG domina el tiempo de render; JPEG a
+        # calidad 85 codifica mucho más rápido y el payload hacia Textract
+        # queda varias veces más chico. Para páginas chicas (<2 MP) se
+        # mantiene PNG sin pérdida, donde el encode ya es barato
+        if pix.width * pix.height >= 2_000_000:
+            return pix.tobytes("jpeg", jpg_quality=85)
+        return pix.tobytes("png")
+    finally:
+        pdf_document.close()
+
+
+def _extraer_tablas_pdf_async(pdf_path: str, bucket: str) -> List[pd.DataFrame]:
+    """
+    Procesa un PDF completo con la API asíncrona de Textract.
+
+    Sube el PDF UNA vez al bucket y llama start_document_analysis: Textract
+    lee el PDF nativo y procesa las páginas en paralelo del lado del
+    servidor, así que desaparecen el render con PyMuPDF y la llamada HTTP
+    por página; queda un start más unos pocos polls. Reutiliza el mismo
+    cache en disco por hash que el camino síncrono.
+    """
+    import hashlib
+    import time
+
+    pdf_bytes = Path(pdf_path).read_bytes()
+
+    hash_pdf = hashlib.sha256(pdf_bytes).hexdigest()
+    ruta_cache = _CACHE_TEXTRACT_DIR / f'{hash_pdf}.json'
+    try:
+        datos = ruta_cache.read_bytes()
+        response = _orjson.loads(datos) if _orjson is not None else json.loads(datos)
+        return parse_tables(response)
+    except (OSError, ValueError):
+        pass
+
+    textract = _get_textract()
+    key = f"textract-tmp/{hash_pdf}.pdf"
+    _get_s3().put_object(Bucket=bucket, Key=key, Body=pdf_bytes)
+    inicio = textract.start_document_analysis(
+        DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}},
+        FeatureTypes=['TABLES']
+    )
+    job_id = inicio['JobId']
+
+    # Poll con espera creciente hasta que el job termine
+    espera = 1.0
+    while True:
+        resultado = textract.get_document_analysis(JobId=job_id, MaxResults=1000)
+        estado = resultado['JobStatus']
+        if estado == 'SUCCEEDED':
+            break
+        if estado == 'FAILED':
+            raise RuntimeError(
+                f"Textract fallo el analisis asincrono: {resultado.get('StatusMessage', '')}"
+            )
+        time.sleep(espera)
+        espera = min(5.0, espera * 1.5)
+
+    # Juntar los Blocks de todas las páginas (la respuesta viene paginada);
+    # parse_tables resuelve por Id de bloque, así que los límites de página
+    # no lo afectan
+    blocks = list(resultado.get('Blocks', []))
+    token = resultado.get('NextToken')
+    while token:
+        resultado = textract.get_document_analysis(
+            JobId=job_id, MaxResults=1000, NextToken=token
+        )
+        blocks.extend(resultado.get('Blocks', []))
+        token = resultado.get('NextToken')
+
+    response = {'Blocks': blocks}
+    try:
+        _CACHE_TEXTRACT_DIR.mkdir(exist_ok=True)
+        if _orjson is not None:
+            ruta_cache.write_bytes(_orjson.dumps(response))
+        else:
+            ruta_cache.write_text(json.dumps(response), encoding='utf-8')
+    except (OSError, TypeError):
+        pass
+
+    return parse_tables(response)
+
+
+def _reintentar_con_backoff(funcion, *args):
+    """
+    Ejecuta funcion(*args) reintentando ante throttling de Textract.
+
+    Backoff exponencial con jitter sobre ThrottlingException /
+    ProvisionedThroughputExceededException, además de los reintentos
+    adaptativos que ya trae el cliente. Cualquier otro error se propaga.
+    """
+    import random
+    import time
+
+    for intento in range(5):
+        try:
+            return funcion(*args)
+        except Exception as e:
+            codigo = getattr(e, 'response', {}).get('Error', {}).get('Code', '')
+            if codigo not in ('ThrottlingException', 'ProvisionedThroughputExceededException'):
+                raise
+            espera = min(60.0, 2 ** intento + random.random())
+            print(f"  [ADVERTENCIA] Textract limito la tasa, reintentando en {espera:.1f}s...")
+            time.sleep(espera)
+    return funcion(*args)
+
+
 def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
     """
     Extrae tablas de una imagen o PDF usando Amazon Textract de forma eficiente.
@@ -16,8 +344,8 @@ def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
     Returns:
         Lista de DataFrames, uno por cada tabla encontrada
     """
-    # Inicializar cliente de Textract
-    textract = boto3.client('textract')
+    # Cliente de Textract (cacheado a nivel de módulo)
+    textract = _get_textract()
 
     # Detectar si es PDF
     file_extension = Path(image_path).suffix.lower()
@@ -25,6 +353,18 @@ def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
     all_dataframes = []
 
     if file_extension == '.pdf':
+        # Con bucket configurado, el PDF va entero a la API asíncrona:
+        # Textract lo lee nativo y procesa las páginas en paralelo del lado
+        # del servidor, sin rasterizar ni una llamada HTTP por página. Si el
+        # camino asíncrono falla, se cae al render local de siempre
+        bucket = _bucket_configurado()
+        if bucket:
+            print("Procesando PDF con la API asincrona de Textract (S3)...")
+            try:
+                return _reintentar_con_backoff(_extraer_tablas_pdf_async, image_path, bucket)
+            except Exception as e:
+                print(f"  [ADVERTENCIA] Fallo el analisis asincrono ({e}), se rasteriza localmente...")
+
         # Usar PyMuPDF para convertir PDF a imágenes (sin dependencias externas)
         try:
             import fitz  # PyMuPDF
@@ -37,32 +377,42 @@ def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
         print("Convirtiendo PDF a imagenes...")
         try:
             pdf_document = fitz.open(image_path)
-            print(f"Se encontraron {len(pdf_document)} pagina(s)")
-
-            # Procesar cada página
-            for page_num in range(len(pdf_document)):
-                print(f"Procesando pagina {page_num + 1}/{len(pdf_document)}...")
-
-                # Obtener la página
-                page = pdf_document[page_num]
-
-                # Convertir página a imagen (matriz de píxeles)
-                pix = page.get_pixmap(dpi=300)
-
-                # Convertir a bytes PNG
-                image_bytes = pix.tobytes("png")
-
-                # Llamar a Textract
-                response = textract.analyze_document(
-                    Document={'Bytes': image_bytes},
-                    FeatureTypes=['TABLES']
-                )
+            num_paginas = len(pdf_document)
+            pdf_document.close()
+            print(f"Se encontraron {num_paginas} pagina(s)")
 
-                # Extraer tablas de esta página
-                page_dataframes = parse_tables(response)
-                all_dataframes.extend(page_dataframes)
+            # Con varias páginas en vuelo el throttling es más probable,
+            # de ahí el backoff por página
+            def _analizar_pagina(imagen_bytes):
+                return _reintentar_con_backoff(_analizar_documento, textract, imagen_bytes)
 
-            pdf_document.close()
+            if num_paginas == 1:
+                respuestas = [_analizar_pagina(_renderizar_pagina(image_path, 0))]
+            else:
+                # Pipeline render→Textract: el raster (CPU-bound) corre en un
+                # pool de procesos y cada página pasa al pool de hilos de
+                # Textract (I/O-bound) apenas termina de renderizarse, en vez
+                # de esperar a que todas las páginas estén rasterizadas.
+                # CPU y red quedan solapados; respuestas conserva el orden
+                respuestas = [None] * num_paginas
+                with concurrent.futures.ProcessPoolExecutor() as pool_render, \
+                        concurrent.futures.ThreadPoolExecutor(
+                            max_workers=min(4, num_paginas)) as pool_textract:
+                    renders = {
+                        pool_render.submit(_renderizar_pagina, image_path, num): num
+                        for num in range(num_paginas)
+                    }
+                    analisis = {}
+                    for futuro in concurrent.futures.as_completed(renders):
+                        pagina = renders[futuro]
+                        analisis[pool_textract.submit(_analizar_pagina, futuro.result())] = pagina
+                    for futuro in concurrent.futures.as_completed(analisis):
+                        respuestas[analisis[futuro]] = futuro.result()
+
+            # Extraer las tablas de cada página, en orden
+            for page_num, response in enumerate(respuestas):
+                print(f"Procesando pagina {page_num + 1}/{num_paginas}...")
+                all_dataframes.extend(parse_tables(response))
 
         except Exception as e:
             print(f"\nERROR: No se pudo convertir el PDF: {str(e)}")
@@ -73,11 +423,8 @@ def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
         with open(image_path, 'rb') as document:
             image_bytes = document.read()
 
-        # Llamar a Textract - solo feature TABLES para minimizar costos
-        response = textract.analyze_document(
-            Document={'Bytes': image_bytes},
-            FeatureTypes=['TABLES']  # Solo tablas, no FORMS ni QUERIES
-        )
+        # Llamar a Textract (inline o vía S3 según tamaño y configuración)
+        response = _reintentar_con_backoff(_analizar_documento, textract, image_bytes)
 
         # Extraer tablas del response
         all_dataframes = parse_tables(response)
@@ -85,6 +432,32 @@ def extract_tables_from_image(image_path: str) -> List[pd.DataFrame]:
     return all_dataframes
 
 
+def extract_tables_batch(paths: List[str], max_workers: int = 8) -> List[List[pd.DataFrame]]:
+    """
+    Procesa varios archivos con Textract en paralelo.
+
+    Las llamadas a analyze_document son I/O de red, así que un pool de hilos
+    las solapa hasta el tope de TPS de la cuenta. El backoff ante throttling
+    ocurre por llamada, dentro de extract_tables_from_image (ver
+    _reintentar_con_backoff).
+
+    Args:
+        paths: Rutas de imágenes o PDFs
+        max_workers: Tope de llamadas en vuelo simultáneas
+
+    Returns:
+        Lista con el resultado de extract_tables_from_image por archivo,
+        en el mismo orden que paths
+    """
+    rutas = [str(path) for path in paths]
+
+    if len(rutas) == 1:
+        return [extract_tables_from_image(rutas[0])]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(rutas))) as executor:
+        return list(executor.map(extract_tables_from_image, rutas))
+
+
 def parse_tables(response: Dict) -> List[pd.DataFrame]:
     """
     Parsea la respuesta de Textract y convierte las tablas a DataFrames.
@@ -97,77 +470,80 @@ def parse_tables(response: Dict) -> List[pd.DataFrame]:
     """
     blocks = response['Blocks']
 
-    # Crear diccionario de bloques por ID para acceso rápido
-    block_map = {block['Id']: block for block in blocks}
-
-    # Encontrar todos los bloques de tipo TABLE
-    table_blocks = [block for block in blocks if block['BlockType'] == 'TABLE']
+    # Partición por tipo en UNA sola pasada sobre blocks (antes eran tres
+    # recorridos completos, uno por comprehension). Los índices especializados
+    # reemplazan al block_map genérico: cada lookup va directo al dict de su
+    # tipo y no hay que re-chequear el BlockType de cada hijo
+    cell_map = {}
+    word_text = {}
+    table_blocks = []
+    for block in blocks:
+        tipo = block['BlockType']
+        if tipo == 'CELL':
+            cell_map[block['Id']] = block
+        elif tipo == 'WORD':
+            word_text[block['Id']] = block.get('Text', '')
+        elif tipo == 'TABLE':
+            table_blocks.append(block)
 
     dataframes = []
 
     for table in table_blocks:
-        # Construir matriz de la tabla
-        rows_dict = {}
-
+        # Recolectar las celdas de la tabla
+        celdas = []
         if 'Relationships' in table:
             for relationship in table['Relationships']:
                 if relationship['Type'] == 'CHILD':
                     for cell_id in relationship['Ids']:
-                        cell = block_map[cell_id]
-                        if cell['BlockType'] == 'CELL':
-                            row_index = cell['RowIndex']
-                            col_index = cell['ColumnIndex']
-
-                            # Obtener texto de la celda
-                            cell_text = get_cell_text(cell, block_map)
-
-                            # Almacenar en diccionario
-                            if row_index not in rows_dict:
-                                rows_dict[row_index] = {}
-                            rows_dict[row_index][col_index] = cell_text
-
-        # Convertir a DataFrame
-        if rows_dict:
-            # Ordenar filas y columnas
-            sorted_rows = sorted(rows_dict.items())
-
-            # Construir lista de listas
-            table_data = []
-            for _, row in sorted_rows:
-                sorted_cols = sorted(row.items())
-                table_data.append([text for _, text in sorted_cols])
-
-            # Crear DataFrame (primera fila como header si existe)
-            if len(table_data) > 1:
-                df = pd.DataFrame(table_data[1:], columns=table_data[0])
-            else:
-                df = pd.DataFrame(table_data)
+                        cell = cell_map.get(cell_id)
+                        if cell is not None:
+                            celdas.append(cell)
+
+        if not celdas:
+            continue
+
+        # Grilla densa R x C en lugar del dict-de-dicts + sorts: cada CELL ya
+        # trae RowIndex/ColumnIndex y el bloque TABLE trae RowCount y
+        # ColumnCount, así que el texto se escribe directo en su posición
+        num_filas = table.get('RowCount') or max(c['RowIndex'] for c in celdas)
+        num_cols = table.get('ColumnCount') or max(c['ColumnIndex'] for c in celdas)
+        grid = np.empty((num_filas, num_cols), dtype=object)
+        grid.fill('')
+        for cell in celdas:
+            grid[cell['RowIndex'] - 1, cell['ColumnIndex'] - 1] = get_cell_text(cell, word_text)
+
+        # Crear DataFrame (primera fila como header si existe)
+        if num_filas > 1:
+            df = pd.DataFrame(grid[1:], columns=grid[0])
+        else:
+            df = pd.DataFrame(grid)
 
-            dataframes.append(df)
+        dataframes.append(df)
 
     return dataframes
 
 
-def get_cell_text(cell: Dict, block_map: Dict) -> str:
+def get_cell_text(cell: Dict, word_text: Dict) -> str:
     """
     Extrae el texto de una celda.
 
     Args:
         cell: Bloque de celda
-        block_map: Diccionario de bloques por ID
+        word_text: Diccionario id → texto de los bloques WORD (pre-indexado
+            una sola vez en parse_tables)
 
     Returns:
         Texto de la celda
     """
-    text = ""
-    if 'Relationships' in cell:
-        for relationship in cell['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for word_id in relationship['Ids']:
-                    word = block_map.get(word_id)
-                    if word and word['BlockType'] == 'WORD':
-                        text += word.get('Text', '') + " "
-    return text.strip()
+    rels = cell.get('Relationships')
+    if not rels:
+        return ''
+
+    # Textract agrupa todos los hijos de una celda en una sola relación CHILD.
+    # Los hijos que no son WORD (p. ej. SELECTION_ELEMENT) no están en el
+    # índice y se saltan con el filtro de membresía
+    ids = rels[0]['Ids'] if rels[0]['Type'] == 'CHILD' else ()
+    return ' '.join(word_text[word_id] for word_id in ids if word_id in word_text)
 
 
 def limpiar_datos(df: pd.DataFrame, tipo_operacion: str = 'entrada') -> pd.DataFrame:
@@ -203,23 +579,23 @@ def limpiar_datos_entrada(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         DataFrame con columnas: ['Producto', 'Cantidad']
     """
-    df_clean = df.copy()
-
-    # Normalizar nombres de columnas
-    df_clean.columns = df_clean.columns.str.strip().str.lower()
+    # Normalizar nombres de columnas con set_axis: comparte los datos con el
+    # DataFrame original en vez de copiarlo entero (aquí solo se lee; el
+    # resultado se construye como un DataFrame nuevo más abajo)
+    df_clean = df.set_axis(df.columns.str.strip().str.lower(), axis=1)
 
     # Buscar columna de cantidad
     cantidad_col = None
 
     # ENTRADA: Busca columna "Cantidad" explícitamente (pedidos con encabezado)
+    # con un solo barrido vectorizado sobre el Index, en vez del loop columna
+    # por columna. IMPORTANTE: buscar 'cantidad' (exacto), no 'unid' que puede
+    # confundirse con 'unidad'
     print("  * Modo ENTRADA: Buscando columna 'Cantidad'...")
-    for col in df_clean.columns:
-        col_lower = str(col).lower()
-        # IMPORTANTE: Buscar 'cantidad' primero (exacto), no 'unid' que puede confundirse con 'unidad'
-        if 'cantidad' in col_lower or 'cant.' in col_lower or 'qty' in col_lower:
-            cantidad_col = col
-            print(f"  [OK] Columna de cantidad encontrada: '{col}'")
-            break
+    mask_cantidad = df_clean.columns.astype(str).str.contains(r'cantidad|cant\.|qty', regex=True)
+    if mask_cantidad.any():
+        cantidad_col = df_clean.columns[mask_cantidad][0]
+        print(f"  [OK] Columna de cantidad encontrada: '{cantidad_col}'")
 
     if cantidad_col is None:
         # Intentar usar la última columna como cantidad
@@ -273,34 +649,45 @@ def limpiar_datos_entrada(df: pd.DataFrame) -> pd.DataFrame:
         print(f"  * Usando primera columna '{primera_col}' como Producto")
         producto_col = primera_col
 
-    # Seleccionar solo esas columnas y renombrar
-    df_clean = df_clean[[producto_col, cantidad_col]].copy()
-    df_clean.columns = ['Producto', 'Cantidad']
-
-    # Limpiar valores nulos y vacíos
-    df_clean = df_clean.dropna(subset=['Producto', 'Cantidad'])
-    # Convertir Producto a string antes de usar .str accessor
-    df_clean['Producto'] = df_clean['Producto'].astype(str)
-    df_clean = df_clean[df_clean['Producto'].str.strip() != '']
-
-    # Convertir cantidad a numérico (reemplazar comas por puntos primero)
-    df_clean['Cantidad'] = df_clean['Cantidad'].astype(str).str.replace(',', '.')
-    df_clean['Cantidad'] = pd.to_numeric(df_clean['Cantidad'], errors='coerce')
-    df_clean = df_clean.dropna(subset=['Cantidad'])
-
-    # Limpiar espacios en producto
-    df_clean['Producto'] = df_clean['Producto'].str.strip()
-
-    # Eliminar prefijos numéricos (1., 1-, 14.-, etc.) del inicio del nombre del producto
-    # Patrón: número(s) + punto/guión/espacio al inicio
-    df_clean['Producto'] = df_clean['Producto'].apply(
-        lambda x: re.sub(r'^\d+[\.\-\s]+[\|\s]*', '', x).strip()
-    )
-
-    # Eliminar prefijos de error de OCR (I, |, i) al inicio del producto
-    df_clean['Producto'] = df_clean['Producto'].apply(
-        lambda x: re.sub(r'^[I\|i]\s*', '', x).strip()
-    )
+    # Parsear cantidad (reemplazar comas por puntos primero) y producto en una
+    # sola pasada: una máscara booleana combinada reemplaza la cadena de
+    # dropna/filtrados que reconstruía el DataFrame en cada paso.
+    # regex=False evita compilar una expresión regular para un reemplazo literal
+    columna_cantidad = df_clean[cantidad_col]
+    if pd.api.types.is_numeric_dtype(columna_cantidad):
+        # Camino rápido: read_csv/pyarrow ya entregaron números, no hay
+        # comas decimales que limpiar ni strings que convertir
+        cantidad = columna_cantidad
+    else:
+        cantidad = pd.to_numeric(
+            columna_cantidad.astype(str).str.replace(',', '.', regex=False),
+            errors='coerce'
+        )
+    producto = df_clean[producto_col].astype(str).str.strip()
+    mask = cantidad.notna() & df_clean[producto_col].notna() & (producto != '')
+
+    # downcast: las cantidades de un pedido entran de sobra en enteros chicos
+    # (menos memoria y groupby más rápido); si hay decimales, to_numeric
+    # mantiene el dtype flotante original
+    df_clean = pd.DataFrame({
+        'Producto': producto[mask].values,
+        'Cantidad': pd.to_numeric(cantidad[mask].values, downcast='integer')
+    })
+
+    # Eliminar prefijos del producto en una sola pasada vectorizada: el patrón
+    # de módulo _PREFIJOS_PRODUCTO combina los prefijos numéricos (1., 1-,
+    # 14.-, etc.) y los errores de OCR (I, |, i) al inicio, así que las dos
+    # pasadas con apply + re.sub por fila se fusionan en un str.replace en C
+    df_clean['Producto'] = df_clean['Producto'].str.replace(
+        _PREFIJOS_PRODUCTO, '', regex=True
+    ).str.strip()
+
+    # Con pyarrow disponible, la columna de texto pasa al backend Arrow: las
+    # operaciones .str posteriores corren sobre kernels en C y cada string
+    # ocupa menos memoria. Se hace al final porque str.replace con un patrón
+    # ya compilado no está soportado sobre ArrowDtype
+    if _pacsv is not None:
+        df_clean['Producto'] = df_clean['Producto'].astype('string[pyarrow]')
 
     return df_clean.reset_index(drop=True)
 
@@ -328,33 +715,32 @@ def limpiar_datos_salida(df: pd.DataFrame, config_path: str = 'config.json') ->
         DataFrame con columnas: ['Producto', 'Cantidad']
     """
     # Cargar productos válidos
-    with open(config_path, 'r', encoding='utf-8') as f:
-        config = json.load(f)
+    config = _cargar_config(config_path)
 
-    productos_validos_salida = set()
-    for categoria, info in config.items():
-        if not isinstance(info, dict) or 'variantes' not in info:
-            continue
-        for variante in info['variantes']:
-            salidas = variante.get('salida', [])
-            for salida in salidas:
-                productos_validos_salida.add(normalizar_texto(salida))
+    productos_validos_salida = {texto for texto, _, _ in _aplanar_config(config, 'salida')}
 
     if not productos_validos_salida:
         raise ValueError("No se encontraron productos de salida válidos en config.json")
 
     print(f"  * Cargados {len(productos_validos_salida)} productos válidos de salida")
 
-    df_clean = df.copy()
-    if len(df_clean.columns) > 0:
-        df_clean.columns = df_clean.columns.astype(str).str.strip().str.lower()
-
-    resultados = []
+    # La función solo LEE las filas (row.values), así que no hace falta
+    # copiar el DataFrame completo ni renombrar encabezados.
+    # Arrays preallocados al máximo posible (una fila por fila de entrada);
+    # se recortan a k al construir el DataFrame, sin dicts intermedios
+    n = len(df)
+    productos_arr = np.empty(n, dtype=object)
+    cantidades_arr = np.empty(n, dtype=np.int64)
+    k = 0
     productos_filtrados = []
 
-    for idx, row in df_clean.iterrows():
+    # Materializar las filas como listas de Python UNA vez: iterar listas es
+    # mucho más barato que iterrows, que construye una Series por fila
+    filas = df.to_numpy(dtype=object).tolist()
+
+    for fila in filas:
         # Convertir toda la fila a lista de strings
-        valores = [str(v).strip() if pd.notna(v) else '' for v in row.values]
+        valores = [str(v).strip() if pd.notna(v) else '' for v in fila]
 
         if not any(valores):
             continue
@@ -371,7 +757,13 @@ def limpiar_datos_salida(df: pd.DataFrame, config_path: str = 'config.json') ->
             # FILTRO: verificar si es producto válido
             es_producto_valido = False
             for producto_config in productos_validos_salida:
-                if producto_normalizado in producto_config or producto_config in producto_normalizado:
+                # Una sola llamada a substring por par: el string corto solo
+                # puede estar contenido en el largo, no al revés
+                if len(producto_normalizado) >= len(producto_config):
+                    coincide = producto_config in producto_normalizado
+                else:
+                    coincide = producto_normalizado in producto_config
+                if coincide:
                     es_producto_valido = True
                     break
 
@@ -426,53 +818,62 @@ def limpiar_datos_salida(df: pd.DataFrame, config_path: str = 'config.json') ->
 
             # Si encontramos una cantidad válida, agregar el resultado
             if cantidad is not None and cantidad > 0:
-                resultados.append({
-                    'Producto': producto,
-                    'Cantidad': cantidad
-                })
+                productos_arr[k] = producto
+                cantidades_arr[k] = cantidad
+                k += 1
             else:
                 # Debug: mostrar qué valores se encontraron
                 print(f"  [ADVERTENCIA] No se encontro cantidad entera para '{producto}': valores = {valores[1:]}")
 
     if productos_filtrados:
-        productos_unicos = list(set(productos_filtrados))[:5]
+        # dict.fromkeys deduplica preservando orden e islice corta en 5 sin
+        # materializar el conjunto completo de filas descartadas
+        productos_unicos = list(itertools.islice(dict.fromkeys(productos_filtrados), 5))
         print(f"  * Filtrados {len(productos_filtrados)} datos no-inventario: {', '.join(productos_unicos)}...")
 
-    if not resultados:
+    if k == 0:
         raise ValueError("No se encontraron productos válidos en los datos de salida")
 
-    df_final = pd.DataFrame(resultados)
-    df_final['Producto'] = df_final['Producto'].str.strip()
-    df_final['Producto'] = df_final['Producto'].apply(
-        lambda x: re.sub(r'^\d+[\.\-\s]+[\|\s]*', '', x).strip()
+    df_final = pd.DataFrame(
+        {'Producto': productos_arr[:k],
+         'Cantidad': pd.to_numeric(cantidades_arr[:k], downcast='integer')},
+        copy=False
     )
-    df_final['Producto'] = df_final['Producto'].apply(
-        lambda x: re.sub(r'^[I\|i]\s*', '', x).strip()
+    # Eliminar prefijos numéricos y de OCR en una sola pasada vectorizada
+    df_final['Producto'] = (
+        df_final['Producto']
+        .str.strip()
+        .str.replace(_PREFIJOS_PRODUCTO, '', regex=True)
+        .str.strip()
     )
+    # Backend Arrow para la columna de texto, igual que en entrada
+    if _pacsv is not None:
+        df_final['Producto'] = df_final['Producto'].astype('string[pyarrow]')
 
     print(f"  [OK] Procesados {len(df_final)} productos de salida (ventas)")
     return df_final.reset_index(drop=True)
 
 
+@functools.lru_cache(maxsize=4096)
 def normalizar_texto(texto: str) -> str:
     """
     Normaliza un texto eliminando espacios, puntos, guiones y caracteres especiales.
     Mantiene números y letras. Convierte todo a minúsculas para facilitar comparaciones.
 
+    El resultado se cachea (lru_cache): los mismos nombres de producto se
+    repiten fila tras fila y entre cargas en Gradio, así que normalizarlos
+    una sola vez ahorra trabajo de strings proporcional a los duplicados.
+
     Args:
         texto: Texto a normalizar
 
     Returns:
         Texto normalizado (solo letras y números en minúsculas, sin espacios ni puntuación)
     """
-    # Convertir a minúsculas
-    texto = texto.lower().strip()
-
-    # Eliminar puntos, guiones, espacios, y caracteres especiales comunes
-    # Mantener solo letras y números
-    texto_limpio = re.sub(r'[^a-záéíóúñ0-9]', '', texto)
-
-    return texto_limpio
+    # Minúsculas y luego el patrón de módulo _NORM_RE elimina puntuación,
+    # espacios y demás caracteres especiales en una sola pasada (el strip es
+    # innecesario: los espacios también caen en el patrón)
+    return _NORM_RE.sub('', texto.lower())
 
 
 def validar_y_multiplicar(df_clean: pd.DataFrame, config_path: str = 'config.json', tipo_operacion: str = 'entrada') -> pd.DataFrame:
@@ -500,61 +901,95 @@ def validar_y_multiplicar_entrada(df_clean: pd.DataFrame, config_path: str = 'co
         DataFrame con columnas:
         ['Producto', 'Cantidad_Original', 'Multiplicador', 'Cantidad_Final', 'Categoria']
     """
-    with open(config_path, 'r', encoding='utf-8') as f:
-        config = json.load(f)
-
-    resultados = []
-    productos_no_encontrados = []
-
-    for _, row in df_clean.iterrows():
-        producto = row['Producto']
-        cantidad = row['Cantidad']
-        producto_normalizado = normalizar_texto(producto)
-        encontrado = False
-
-        for categoria, info in config.items():
-            if not isinstance(info, dict) or 'variantes' not in info:
-                continue
+    config = _cargar_config(config_path)
+
+    # Aplanar config UNA vez en una lista (entrada_norm, categoria,
+    # multiplicador): el join exacto cubre el caso común (el OCR devuelve el
+    # nombre tal cual está en config.json) y la lista alimenta el fallback
+    # por substring, en lugar del triple loop categoría→variante→entrada por fila
+    entradas_planas = _aplanar_config(config, 'entrada')
+
+    # Join vectorizado sobre la clave normalizada: reemplaza el loop fila a
+    # fila con iterrows por un hash-join a nivel C de pandas
+    entradas_df = pd.DataFrame(
+        entradas_planas,
+        columns=['entrada_norm', 'Categoria', 'Multiplicador']
+    ).drop_duplicates(subset='entrada_norm', keep='first')
+
+    merged = df_clean[['Producto', 'Cantidad']].copy()
+    merged['producto_norm'] = merged['Producto'].map(normalizar_texto)
+    merged = merged.merge(
+        entradas_df, left_on='producto_norm', right_on='entrada_norm', how='left'
+    )
 
-            variantes = info['variantes']
-            for variante in variantes:
-                entradas = variante.get('entrada', [])
-                multiplicador = variante['multiplicador']
-
-                for entrada in entradas:
-                    entrada_normalizada = normalizar_texto(entrada)
-                    if entrada_normalizada in producto_normalizado or producto_normalizado in entrada_normalizada:
-                        cantidad_final = cantidad * multiplicador
-                        resultados.append({
-                            'Producto': producto,
-                            'Cantidad_Original': cantidad,
-                            'Multiplicador': multiplicador,
-                            'Cantidad_Final': cantidad_final,
-                            'Categoria': categoria
-                        })
-                        encontrado = True
-                        break
-                if encontrado:
-                    break
-            if encontrado:
-                break
+    # Fallback por substring SOLO para las filas sin coincidencia exacta.
+    # Con pyahocorasick, la dirección "entrada contenida en el producto" se
+    # resuelve con una pasada del autómata en O(len(producto)); sin él se
+    # prueba entrada por entrada como siempre
+    sin_match = merged.index[merged['Multiplicador'].isna()]
+    automata = None
+    if len(sin_match) > 0 and _ahocorasick is not None:
+        automata = _ahocorasick.Automaton()
+        for fila in entradas_df.itertuples(index=False):
+            if fila.entrada_norm:
+                automata.add_word(fila.entrada_norm, (fila.Categoria, fila.Multiplicador))
+        automata.make_automaton()
+
+    def _resolver_fallback(producto_normalizado):
+        """Devuelve (categoria, multiplicador) por substring, o None"""
+        if automata is not None:
+            hit = next(automata.iter(producto_normalizado), None)
+            if hit is not None:
+                return hit[1]
+            # Dirección inversa (producto contenido en una entrada): el
+            # autómata no la cubre, se recorre la lista plana
+            for entrada_normalizada, categoria, multiplicador in entradas_planas:
+                if producto_normalizado in entrada_normalizada:
+                    return categoria, multiplicador
+            return None
+        for entrada_normalizada, categoria, multiplicador in entradas_planas:
+            # Comparar longitudes primero: así solo se hace una llamada a
+            # substring por par (el corto contenido en el largo)
+            if len(producto_normalizado) >= len(entrada_normalizada):
+                coincide = entrada_normalizada in producto_normalizado
+            else:
+                coincide = producto_normalizado in entrada_normalizada
+            if coincide:
+                return categoria, multiplicador
+        return None
 
-        if not encontrado:
-            productos_no_encontrados.append(producto)
-            categoria_no_registrada = f"{producto} (no registrado)"
-            print(f"  [ADVERTENCIA] Producto no registrado: '{producto}'")
-            resultados.append({
-                'Producto': producto,
-                'Cantidad_Original': cantidad,
-                'Multiplicador': 1,
-                'Cantidad_Final': cantidad,
-                'Categoria': categoria_no_registrada
-            })
+    # Memoizar por producto normalizado: los SKU repetidos del pedido no
+    # vuelven a pagar el barrido por substring. Dict local (no lru_cache de
+    # módulo) porque el resultado depende del config vigente en esta llamada
+    resueltos = {}
+    for idx in sin_match:
+        producto_normalizado = merged.at[idx, 'producto_norm']
+        if producto_normalizado not in resueltos:
+            resueltos[producto_normalizado] = _resolver_fallback(producto_normalizado)
+        resultado = resueltos[producto_normalizado]
+        if resultado is not None:
+            merged.at[idx, 'Categoria'], merged.at[idx, 'Multiplicador'] = resultado
+
+    # Productos sin registrar: multiplicador 1 y categoría marcada
+    sin_registrar = merged['Multiplicador'].isna()
+    productos_no_encontrados = merged.loc[sin_registrar, 'Producto'].tolist()
+    for producto in productos_no_encontrados:
+        print(f"  [ADVERTENCIA] Producto no registrado: '{producto}'")
+    merged.loc[sin_registrar, 'Multiplicador'] = 1
+    merged.loc[sin_registrar, 'Categoria'] = merged.loc[sin_registrar, 'Producto'] + ' (no registrado)'
 
     if productos_no_encontrados:
         print(f"\n[ADVERTENCIA] Se encontraron {len(productos_no_encontrados)} producto(s) no registrado(s) en config.json")
 
-    return pd.DataFrame(resultados)
+    # downcast='integer' achica las columnas numéricas cuando los valores son
+    # enteros (lo habitual en inventario); con decimales deja el dtype como está
+    return pd.DataFrame({
+        'Producto': merged['Producto'],
+        'Cantidad_Original': pd.to_numeric(merged['Cantidad'], downcast='integer'),
+        'Multiplicador': pd.to_numeric(merged['Multiplicador'], downcast='integer'),
+        'Cantidad_Final': pd.to_numeric(merged['Cantidad'] * merged['Multiplicador'], downcast='integer'),
+        'Categoria': merged['Categoria']
+    })
 
 
 def validar_y_multiplicar_salida(df_clean: pd.DataFrame, config_path: str = 'config.json') -> pd.DataFrame:
@@ -573,61 +1008,103 @@ def validar_y_multiplicar_salida(df_clean: pd.DataFrame, config_path: str = 'con
         ['Producto', 'Cantidad_Original', 'Multiplicador', 'Cantidad_Final', 'Categoria']
         Nota: Multiplicador siempre es 1, Cantidad_Final = Cantidad_Original
     """
-    with open(config_path, 'r', encoding='utf-8') as f:
-        config = json.load(f)
+    config = _cargar_config(config_path)
+
+    # Aplanar el campo "salida" UNA vez, igual que en entrada: el join exacto
+    # sobre la clave normalizada cubre el caso común y la lista plana alimenta
+    # el fallback por substring, en lugar del triple loop por fila con iterrows
+    salidas_planas = _aplanar_config(config, 'salida')
+
+    salidas_df = pd.DataFrame(
+        salidas_planas,
+        columns=['salida_norm', 'Categoria', 'Multiplicador']
+    )[['salida_norm', 'Categoria']].drop_duplicates(subset='salida_norm', keep='first')
+
+    merged = df_clean[['Producto', 'Cantidad']].copy()
+    merged['producto_norm'] = merged['Producto'].map(normalizar_texto)
+    merged = merged.merge(
+        salidas_df, left_on='producto_norm', right_on='salida_norm', how='left'
+    )
 
-    resultados = []
-    productos_no_encontrados = []
+    # Fallback por substring SOLO para las filas sin coincidencia exacta,
+    # memoizado por producto normalizado para no repetir el barrido en
+    # productos duplicados de la factura
+    sin_match = merged.index[merged['Categoria'].isna()]
+    resueltos = {}
+    for idx in sin_match:
+        producto_normalizado = merged.at[idx, 'producto_norm']
+        if producto_normalizado not in resueltos:
+            # Una sola llamada a substring por par: el corto en el largo
+            largo_producto = len(producto_normalizado)
+            resueltos[producto_normalizado] = next(
+                (categoria for salida_normalizada, categoria, _ in salidas_planas
+                 if (salida_normalizada in producto_normalizado
+                     if largo_producto >= len(salida_normalizada)
+                     else producto_normalizado in salida_normalizada)),
+                None
+            )
+        if resueltos[producto_normalizado] is not None:
+            merged.at[idx, 'Categoria'] = resueltos[producto_normalizado]
+
+    # Productos sin registrar: mantener la fila con la categoría marcada
+    sin_registrar = merged['Categoria'].isna()
+    productos_no_encontrados = merged.loc[sin_registrar, 'Producto'].tolist()
+    for producto in productos_no_encontrados:
+        print(f"  [ADVERTENCIA] Producto de salida no registrado: '{producto}'")
+    merged.loc[sin_registrar, 'Categoria'] = merged.loc[sin_registrar, 'Producto'] + ' (no registrado)'
 
-    for _, row in df_clean.iterrows():
-        producto = row['Producto']
-        cantidad = row['Cantidad']
-        producto_normalizado = normalizar_texto(producto)
-        encontrado = False
+    if productos_no_encontrados:
+        print(f"\n[ADVERTENCIA] Se encontraron {len(productos_no_encontrados)} producto(s) de salida no registrado(s)")
 
-        for categoria, info in config.items():
-            if not isinstance(info, dict) or 'variantes' not in info:
-                continue
+    # Las salidas NO multiplican: las ventas ya vienen en unidades.
+    # downcast achica la columna a enteros chicos cuando los valores lo permiten
+    cantidad = pd.to_numeric(merged['Cantidad'], downcast='integer')
+    return pd.DataFrame({
+        'Producto': merged['Producto'],
+        'Cantidad_Original': cantidad,
+        'Multiplicador': 1,
+        'Cantidad_Final': cantidad,
+        'Categoria': merged['Categoria']
+    })
 
-            variantes = info['variantes']
-            for variante in variantes:
-                salidas = variante.get('salida', [])
-                if not salidas:
-                    continue
 
-                for salida in salidas:
-                    salida_normalizada = normalizar_texto(salida)
-                    if salida_normalizada in producto_normalizado or producto_normalizado in salida_normalizada:
-                        resultados.append({
-                            'Producto': producto,  # Mantener el nombre original de la factura
-                            'Cantidad_Original': cantidad,
-                            'Multiplicador': 1,
-                            'Cantidad_Final': cantidad,
-                            'Categoria': categoria
-                        })
-                        encontrado = True
-                        break
-                if encontrado:
-                    break
-            if encontrado:
-                break
+def _leer_valores_excel(path: str):
+    """
+    Lee los VALORES de un Excel en una sola pasada streaming (read_only).
 
-        if not encontrado:
-            productos_no_encontrados.append(producto)
-            categoria_no_registrada = f"{producto} (no registrado)"
-            print(f"  [ADVERTENCIA] Producto de salida no registrado: '{producto}'")
-            resultados.append({
-                'Producto': producto,
-                'Cantidad_Original': cantidad,
-                'Multiplicador': 1,
-                'Cantidad_Final': cantidad,
-                'Categoria': categoria_no_registrada
-            })
+    Evita cargar el workbook completo (estilos + fórmulas) solo para consultar
+    valores: read_only parsea fila por fila y usa una fracción de la memoria.
 
-    if productos_no_encontrados:
-        print(f"\n[ADVERTENCIA] Se encontraron {len(productos_no_encontrados)} producto(s) de salida no registrado(s)")
+    Args:
+        path: Ruta al archivo .xlsx
+
+    Returns:
+        Tupla (valores, max_row) donde valores es un diccionario
+        {(fila, columna): valor} solo con celdas no vacías
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, data_only=True, read_only=True, keep_vba=False)
+    ws = wb.active
 
-    return pd.DataFrame(resultados)
+    valores = {}
+    max_row = 0
+    for row_idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        max_row = row_idx
+        for col_idx, valor in enumerate(row, start=1):
+            if valor is not None:
+                valores[(row_idx, col_idx)] = valor
+
+    wb.close()
+    return valores, max_row
+
+
+# Caché del workbook base editable: en el flujo de Gradio el archivo recién
+# guardado es la base del siguiente click de PROCESAR, así que si no cambió
+# en disco (mtime) se reutiliza el objeto en memoria y se evita re-parsear
+# estilos y fórmulas. El guardado sigue siendo por llamada: cada click deja
+# el archivo completo en Descargas
+_workbook_cache = {'path': None, 'mtime_ns': None, 'wb': None}
 
 
 def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inventario_layout.xlsx', tipo_operacion: str = 'entrada', output_path: str = None) -> str:
@@ -679,11 +1156,14 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
         Ruta del archivo guardado
     """
     from openpyxl import load_workbook
-    from copy import copy
     import os
     import re
 
     try:
+        # Normalizar el tipo de operación UNA vez a la entrada: los loops de
+        # encabezados comparan contra este valor ya resuelto
+        tipo_op = tipo_operacion.lower().strip()
+
         # PASO 1: Comparar fecha del archivo cargado VS fecha seleccionada en el calendario
         misma_fecha = False
 
@@ -741,38 +1221,35 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
             print(f"  - Base: Inventario_layout.xlsx (template de .sistema)")
             print(f"  - Inv Final se copiara desde: {Path(layout_path).name}")
 
-        # Cargar el archivo base
-        wb_original = load_workbook(archivo_base, data_only=False, keep_vba=False)
-        ws_original = wb_original.active
-
-        # SIEMPRE cargar valores del archivo base (template o archivo mismo)
-        wb_valores = load_workbook(archivo_base, data_only=True, keep_vba=False)
-        ws_valores = wb_valores.active
+        # SIEMPRE leer los valores del archivo base (template o archivo mismo)
+        # en una sola pasada streaming, en vez de cargar el workbook completo
+        # una segunda y tercera vez solo para consultar valores
+        valores_base, max_row_base = _leer_valores_excel(archivo_base)
 
-        # Si es FECHA DIFERENTE, cargar ADICIONAL el archivo anterior para copiar Inv Final
-        # IMPORTANTE: NO usar data_only=True porque no funciona si Excel no guardó valores.
-        # En su lugar, cargaremos con data_only=False y CALCULAREMOS manualmente Inv Final
-        wb_inv_final_anterior = None
-        ws_inv_final_anterior = None
+        # Si es FECHA DIFERENTE, leer ADICIONAL los valores del archivo anterior
+        # para copiar Inv Final. Si Excel no guardó los valores calculados,
+        # Inv Final se CALCULARÁ manualmente (B + C - D) más abajo
+        valores_anterior = None
+        max_row_anterior = 0
         if archivo_para_inv_final:
-            # Cargar el archivo con data_only=False para leer TODO (incluyendo fórmulas)
-            wb_inv_final_anterior = load_workbook(archivo_para_inv_final, data_only=False, keep_vba=False)
-            ws_inv_final_anterior = wb_inv_final_anterior.active
-
-            # TAMBIÉN cargar con data_only=True para INTENTAR leer valores calculados
-            # (en caso de que Excel sí haya guardado los valores)
-            wb_inv_final_valores = load_workbook(archivo_para_inv_final, data_only=True, keep_vba=False)
-            ws_inv_final_valores = wb_inv_final_valores.active
-
-        # Crear workbook nuevo para resultado final
-        wb = load_workbook(archivo_base, data_only=False, keep_vba=False)
+            valores_anterior, max_row_anterior = _leer_valores_excel(archivo_para_inv_final)
+
+        # Cargar el workbook editable (una sola vez, con fórmulas y estilos),
+        # reutilizando el objeto cacheado si el archivo no cambió en disco
+        ruta_base_abs = os.path.abspath(archivo_base)
+        mtime_base = os.stat(ruta_base_abs).st_mtime_ns
+        if _workbook_cache['path'] == ruta_base_abs and _workbook_cache['mtime_ns'] == mtime_base:
+            wb = _workbook_cache['wb']
+            print("  - Reutilizando workbook en memoria (archivo base sin cambios)")
+        else:
+            wb = load_workbook(archivo_base, data_only=False, keep_vba=False)
         ws = wb.active
 
         # PASO CRÍTICO: Copiar COLUMNA E → COLUMNA B solo si es FECHA DIFERENTE
         COL_INV_FINAL = 5   # Columna E (5 en índice de Excel)
         COL_INV_INICIAL = 2  # Columna B (2 en índice de Excel)
 
-        if not misma_fecha and ws_inv_final_anterior:
+        if not misma_fecha and valores_anterior is not None:
             # Copiar COLUMNA E (Inv Final) del archivo ORIGEN → COLUMNA B (Inv Inicial) del archivo NUEVO
             # Columna E = Inv Final del archivo anterior (origen)
             # Columna B = Inv Inicial del archivo nuevo (destino)
@@ -787,10 +1264,9 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
             valores_nulos = 0
             valores_calculados_manual = 0
 
-            for row_idx in range(2, ws_inv_final_anterior.max_row + 1):  # Empezar desde fila 2 (saltar encabezado)
+            for row_idx in range(2, max_row_anterior + 1):  # Empezar desde fila 2 (saltar encabezado)
                 # ESTRATEGIA 1: Intentar leer el valor calculado de columna E (si Excel lo guardó)
-                cell_inv_final_valores = ws_inv_final_valores.cell(row=row_idx, column=COL_INV_FINAL)
-                valor_final = cell_inv_final_valores.value
+                valor_final = valores_anterior.get((row_idx, COL_INV_FINAL))
 
                 # Si data_only=True devolvió un valor numérico válido, úsalo
                 if valor_final is not None and isinstance(valor_final, (int, float)):
@@ -800,9 +1276,9 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
                     # ESTRATEGIA 2: data_only=True no funcionó, CALCULAR MANUALMENTE
                     # La fórmula de Inv Final es: =B + C - D
                     # Leer valores de columnas B, C, D del archivo anterior
-                    val_b = ws_inv_final_valores.cell(row=row_idx, column=COL_B_INV_INICIAL).value
-                    val_c = ws_inv_final_valores.cell(row=row_idx, column=COL_C_ENTRADA).value
-                    val_d = ws_inv_final_valores.cell(row=row_idx, column=COL_D_SALIDA).value
+                    val_b = valores_anterior.get((row_idx, COL_B_INV_INICIAL))
+                    val_c = valores_anterior.get((row_idx, COL_C_ENTRADA))
+                    val_d = valores_anterior.get((row_idx, COL_D_SALIDA))
 
                     # Convertir None a 0 para el cálculo
                     val_b = val_b if val_b is not None and isinstance(val_b, (int, float)) else 0
@@ -835,9 +1311,6 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
                 print(f"  [INFO] {valores_calculados_manual} valores calculados manualmente (B+C-D)")
             if valores_nulos > 0:
                 print(f"  [INFO] {valores_nulos} celdas vacías o sin valor calculado fueron omitidas")
-
-            # Cerrar el workbook auxiliar de valores
-            wb_inv_final_valores.close()
         else:
             # MISMA FECHA: NO copiar, mantener el Inv Inicial actual
             print("  [OK] Inv Inicial NO modificado (misma fecha de inventario, continuacion de carga)")
@@ -855,12 +1328,14 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
 
         # IMPORTANTE: Preservar TODAS las columnas de operación (Entrada, Salida, etc.)
         # excepto la que estamos modificando en esta carga
-        for col_idx, col in enumerate(ws.iter_cols(min_row=1, max_row=1), start=1):
-            cell_value = col[0].value
+        # values_only devuelve los valores crudos, sin instanciar un objeto
+        # Cell por encabezado
+        for col_idx, (cell_value,) in enumerate(
+                ws.iter_cols(min_row=1, max_row=1, values_only=True), start=1):
             if cell_value:
                 cell_lower = str(cell_value).lower().strip()
                 # Si es una columna de operación DIFERENTE a la que estamos cargando, protegerla
-                if cell_lower in ['entrada', 'salida'] and cell_lower != tipo_operacion.lower():
+                if cell_lower in ('entrada', 'salida') and cell_lower != tipo_op:
                     columnas_a_no_sobrescribir.add(col_idx)
                     print(f"  [OK] Columna '{cell_value}' NO sera sobrescrita (preservar datos existentes)")
 
@@ -873,44 +1348,41 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
         formulas_convertidas = 0
         formulas_preservadas = 0
 
-        for row_idx in range(1, ws.max_row + 1):
-            for col_idx in range(1, ws.max_column + 1):
+        # frozenset para membresía O(1) en el loop interno
+        columnas_protegidas = frozenset(columnas_a_no_sobrescribir)
+
+        # iter_rows evita una búsqueda de celda por coordenada en cada iteración
+        for row in ws.iter_rows():
+            for cell in row:
                 # SALTAR columnas protegidas (B, E, G)
-                if col_idx in columnas_a_no_sobrescribir:
+                if cell.column in columnas_protegidas:
                     # No tocar esta celda, ya tiene el valor correcto
                     continue
 
-                cell = ws.cell(row=row_idx, column=col_idx)
-                cell_valor = ws_valores.cell(row=row_idx, column=col_idx)
+                valor_celda = valores_base.get((cell.row, cell.column))
 
                 # Si la celda tiene una fórmula
                 if isinstance(cell.value, str) and cell.value.startswith('='):
                     # Convertir a valor
-                    if cell_valor.value is not None:
-                        cell.value = cell_valor.value
+                    if valor_celda is not None:
+                        cell.value = valor_celda
                         formulas_convertidas += 1
                     else:
                         # Si no hay valor, poner 0
                         cell.value = 0
                         formulas_convertidas += 1
-                elif cell_valor.value is not None and cell.value != cell_valor.value:
+                elif valor_celda is not None and cell.value != valor_celda:
                     # Asegurar que usamos valores, no fórmulas
-                    cell.value = cell_valor.value
+                    cell.value = valor_celda
 
         print(f"  [OK] {formulas_convertidas} formulas convertidas a valores")
         print(f"  [OK] Columnas B, E, G preservadas correctamente")
 
-        # Cerrar workbooks auxiliares
-        wb_original.close()
-        wb_valores.close()
-        if wb_inv_final_anterior:
-            wb_inv_final_anterior.close()
-
         # Buscar la columna que contiene el tipo de operación en la primera fila (encabezados)
         col_entrada_idx = None
-        for col_idx, col in enumerate(ws.iter_cols(min_row=1, max_row=1), start=1):
-            cell_value = col[0].value
-            if cell_value and str(cell_value).lower().strip() == tipo_operacion.lower():
+        for col_idx, (cell_value,) in enumerate(
+                ws.iter_cols(min_row=1, max_row=1, values_only=True), start=1):
+            if cell_value and str(cell_value).lower().strip() == tipo_op:
                 col_entrada_idx = col_idx
                 break
 
@@ -926,21 +1398,18 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
         # Verificar si el archivo de salida ya existe
         if output_path and os.path.exists(output_path):
             print(f"    Archivo de salida ya existe: {Path(output_path).name}")
-            # Cargar el archivo de salida existente para leer sus valores
-            wb_salida_existente = load_workbook(output_path, data_only=True, keep_vba=False)
-            ws_salida_existente = wb_salida_existente.active
-
-            for fila_idx, row in enumerate(ws_salida_existente.iter_rows(min_col=1, max_col=1), start=1):
-                cell_value = row[0].value
+            # Cuando el archivo de salida existe, es también el archivo base,
+            # así que sus valores ya están en el snapshot valores_base:
+            # no hay que volver a cargar el workbook
+            for fila_idx in range(1, max_row_base + 1):
+                cell_value = valores_base.get((fila_idx, 1))
                 if cell_value and str(cell_value).strip():
                     categoria = str(cell_value).strip()
                     # Leer el valor actual de la columna de entrada/salida
-                    valor_actual = ws_salida_existente.cell(row=fila_idx, column=col_entrada_idx).value
+                    valor_actual = valores_base.get((fila_idx, col_entrada_idx))
                     if valor_actual is not None and isinstance(valor_actual, (int, float)) and valor_actual > 0:
                         cantidades_existentes[categoria] = valor_actual
                         print(f"    Existente: '{categoria}' = {valor_actual}")
-
-            wb_salida_existente.close()
         else:
             print(f"    Archivo de salida no existe aún, primera carga para esta fecha")
 
@@ -972,57 +1441,97 @@ def actualizar_inventario_layout(df_final: pd.DataFrame, layout_path: str = 'Inv
 
         # Actualizar o crear filas para cada categoría (ahora con merge ya hecho)
         print("  - Actualizando celdas en el Excel...")
+
+        # Estilos de la fila plantilla, capturados UNA sola vez (lazy) y
+        # compartidos por todas las filas nuevas: los estilos de openpyxl son
+        # inmutables, así que reutilizar los mismos objetos es seguro y evita
+        # seis copy() por celda por categoría creada
+        estilos_plantilla = None
+
+        # Mapa categoría → fila y última fila con datos, construidos en UNA
+        # pasada por la columna A: así cada categoría del merge consulta un
+        # dict en vez de re-escanear la hoja entera
+        categoria_a_fila = {}
+        ultima_fila_real = 1
+        for fila_idx, (valor_cat,) in enumerate(ws.iter_rows(min_col=1, max_col=1, values_only=True), start=1):
+            if valor_cat and str(valor_cat).strip():
+                categoria_a_fila.setdefault(str(valor_cat).strip(), fila_idx)
+                ultima_fila_real = fila_idx
+
         for categoria, cantidad in cantidades_por_categoria.items():
             if categoria == 'Sin Categoria':
                 continue  # Ignorar productos sin categoría
 
-            # Buscar la fila que contiene el nombre de la categoría en la primera columna
-            fila_encontrada = False
-            for fila_idx, row in enumerate(ws.iter_rows(min_col=1, max_col=1), start=1):
-                cell_value = row[0].value
-                if cell_value and str(cell_value).strip() == categoria:
-                    # Actualizar la celda en la intersección
-                    target_cell = ws.cell(row=fila_idx, column=col_entrada_idx)
-                    target_cell.value = cantidad
-                    print(f"  + Celda actualizada '{categoria}': {cantidad}")
-                    fila_encontrada = True
-                    break
-
-            if not fila_encontrada:
-                # Encontrar la última fila con datos reales en la primera columna
-                ultima_fila_real = 1
-                for fila_idx in range(1, ws.max_row + 1):
-                    cell_value = ws.cell(row=fila_idx, column=1).value
-                    if cell_value and str(cell_value).strip():
-                        ultima_fila_real = fila_idx
-
+            # Buscar la fila de la categoría en el mapa precalculado
+            fila_categoria = categoria_a_fila.get(categoria)
+            if fila_categoria is not None:
+                # Actualizar la celda en la intersección
+                ws.cell(row=fila_categoria, column=col_entrada_idx).value = cantidad
+                print(f"  + Celda actualizada '{categoria}': {cantidad}")
+            else:
                 # Crear nueva fila inmediatamente después del último producto
                 nueva_fila = ultima_fila_real + 1
 
-                # Copiar estilos de la fila anterior si existe
+                # Materializar la fila nueva UNA vez y escribir por índice,
+                # en lugar de buscar cada celda por coordenada con ws.cell
+                fila_nueva_celdas = next(ws.iter_rows(
+                    min_row=nueva_fila, max_row=nueva_fila,
+                    min_col=1, max_col=ws.max_column
+                ))
+
+                # Aplicar estilos de la fila plantilla si existe
                 if ultima_fila_real > 1:
-                    for col_idx in range(1, ws.max_column + 1):
-                        celda_anterior = ws.cell(row=ultima_fila_real, column=col_idx)
-                        celda_nueva = ws.cell(row=nueva_fila, column=col_idx)
-
-                        # Copiar estilos (bordes, fuente, relleno, alineación)
-                        if celda_anterior.has_style:
-                            celda_nueva.font = copy(celda_anterior.font)
-                            celda_nueva.border = copy(celda_anterior.border)
-                            celda_nueva.fill = copy(celda_anterior.fill)
-                            celda_nueva.number_format = copy(celda_anterior.number_format)
-                            celda_nueva.protection = copy(celda_anterior.protection)
-                            celda_nueva.alignment = copy(celda_anterior.alignment)
-
-                # Asignar valores
-                ws.cell(row=nueva_fila, column=1).value = categoria
-                ws.cell(row=nueva_fila, column=col_entrada_idx).value = cantidad
+                    if estilos_plantilla is None:
+                        # Capturar estilos de la fila plantilla una única vez.
+                        # Se comparte el StyleArray completo (celda._style):
+                        # una asignación por celda en lugar de seis setters,
+                        # cada uno con su pasada por los descriptores de
+                        # openpyxl. El atributo es privado pero estable en la
+                        # serie 3.x; si no existe se cae a los seis atributos
+                        fila_plantilla = next(ws.iter_rows(
+                            min_row=ultima_fila_real, max_row=ultima_fila_real,
+                            min_col=1, max_col=ws.max_column))
+                        try:
+                            estilos_plantilla = [
+                                celda_plantilla._style if celda_plantilla.has_style else None
+                                for celda_plantilla in fila_plantilla
+                            ]
+                            estilos_son_arrays = True
+                        except AttributeError:
+                            estilos_plantilla = [
+                                (celda_plantilla.font, celda_plantilla.border,
+                                 celda_plantilla.fill, celda_plantilla.number_format,
+                                 celda_plantilla.protection, celda_plantilla.alignment)
+                                if celda_plantilla.has_style else None
+                                for celda_plantilla in fila_plantilla
+                            ]
+                            estilos_son_arrays = False
+
+                    for celda_nueva, estilo in zip(fila_nueva_celdas, estilos_plantilla):
+                        if estilo is None:
+                            continue
+                        if estilos_son_arrays:
+                            celda_nueva._style = estilo
+                        else:
+                            (celda_nueva.font, celda_nueva.border, celda_nueva.fill,
+                             celda_nueva.number_format, celda_nueva.protection,
+                             celda_nueva.alignment) = estilo
+
+                # Asignar valores y registrar la fila nueva en el mapa
+                fila_nueva_celdas[0].value = categoria
+                fila_nueva_celdas[col_entrada_idx - 1].value = cantidad
+                categoria_a_fila[categoria] = nueva_fila
+                ultima_fila_real = nueva_fila
                 print(f"  + Creada nueva categoria '{categoria}': {cantidad}")
 
         # Guardar el workbook preservando todos los estilos
         save_path = output_path if output_path else layout_path
         wb.save(save_path)
-        wb.close()
+        # El archivo recién guardado será la base si el usuario vuelve a
+        # hacer click para la misma fecha: cachear el workbook tal cual quedó
+        _workbook_cache['path'] = os.path.abspath(save_path)
+        _workbook_cache['mtime_ns'] = os.stat(save_path).st_mtime_ns
+        _workbook_cache['wb'] = wb
         print(f"\n+ Inventario guardado: '{save_path}'")
 
         if misma_fecha:
@@ -1054,6 +1563,9 @@ if __name__ == "__main__":
         config = json.load(f)
 
     USAR_AWS = config.get('USAR_AWS', False)
+    # Con --verbose se vuelcan las tablas completas; sin él solo un resumen
+    # (to_string formatea todo el DataFrame en memoria y domina el log)
+    VERBOSE = '--verbose' in sys.argv
     #image_path = "WhatsApp Image 2025-11-04 at 10.35.29 PM (1).jpeg"
     image_path = r"C:\Users\Juan Jose\Downloads\ENERO 6.pdf"
     csv_path = "datos_raw.csv"
@@ -1167,13 +1679,13 @@ if __name__ == "__main__":
         else:
             # PASO 1B: Cargar desde CSV
             print(f"Cargando datos desde: {csv_path}")
-            df_raw = pd.read_csv(csv_path, encoding='utf-8-sig', thousands=None, decimal='.')
+            df_raw = leer_csv_raw(csv_path)
             print("Datos cargados exitosamente")
 
         # Mostrar datos raw
         print(f"\nDimensiones: {df_raw.shape[0]} filas x {df_raw.shape[1]} columnas")
         print("\nVista previa del DataFrame raw:")
-        print(df_raw.head(10).to_string(index=False))
+        print(df_raw.head(10))
 
         # PASO 2: Limpiar datos (solo producto y cantidad)
         print("\n" + "="*60)
@@ -1181,7 +1693,10 @@ if __name__ == "__main__":
         df_clean = limpiar_datos(df_raw)
         print(f"Datos limpios: {len(df_clean)} productos encontrados")
         print("\nDataFrame limpio (Producto y Cantidad):")
-        print(df_clean.to_string(index=False))
+        if VERBOSE:
+            print(df_clean.to_string(index=False))
+        else:
+            print(df_clean.head(5))
 
         # PASO 3: Validar contra config.json y multiplicar
         print("\n" + "="*60)
@@ -1196,7 +1711,10 @@ if __name__ == "__main__":
         else:
             print(f"\nProductos validados: {len(df_final)}")
             print("\nDataFrame final:")
-            print(df_final.to_string(index=False))
+            if VERBOSE:
+                print(df_final.to_string(index=False))
+            else:
+                print(df_final.head(5))
 
         # PASO 4: Exportar a Excel (siempre exportar, incluso si está vacío)
         print("\n" + "="*60)